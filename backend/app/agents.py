@@ -2,48 +2,269 @@
 Multi-Agent System для редактирования файлов
 
 Архитектура:
-- Supervisor Agent: координирует работу файловых агентов
-- File Agents: по одному агенту на каждый загруженный файл
+- Supervisor Agent: одним запросом к LLM составляет план обработки файлов
+- File Agents: по одному агенту на каждый загруженный файл,
+  агенты работают параллельно
 """
 
+import asyncio
+import hashlib
+import json
+import mmap
 import os
-from typing import TypedDict, Annotated, List, Dict
+import re
+import tempfile
+import threading
+from collections import OrderedDict
+from string import Template
+from pathlib import Path
+from typing import TypedDict, Annotated, Awaitable, Callable, List, Dict, Optional, Tuple
+from langgraph.checkpoint.memory import MemorySaver
 from langgraph.graph import StateGraph, END
-from langchain_core.messages import HumanMessage, AIMessage, BaseMessage
+from langgraph.graph.message import add_messages
+from langchain_core.messages import HumanMessage, AIMessage, BaseMessage, SystemMessage
+from langchain_core.runnables import RunnableConfig
 from langchain_google_genai import ChatGoogleGenerativeAI
-import operator
+from google.genai import types as genai_types
+
+
+# Каталог, в котором хранятся файлы пользователя
+FILES_DIR = "/app/files"
+
+# Модель Gemini; семейство 2.5 поддерживает неявное кэширование
+# повторяющегося префикса запроса
+MODEL_NAME = "gemini-2.5-flash"
+
+# Лимиты длины ответа File Agent (в токенах); рассуждения модели для
+# File Agent отключены, так как они тоже расходуют этот лимит
+MAX_OUTPUT_TOKENS = 8192
+MIN_OUTPUT_TOKENS = 1024
+
+# Максимальное число одновременных запросов к LLM по умолчанию
+MAX_WORKERS = 8
+
+# Уровни обслуживания Gemini API: priority - минимальная задержка для
+# интерактивных запросов, flex - скидка для фоновых задач
+SERVICE_TIERS = ("standard", "priority", "flex")
+
+# Batch API: конечные статусы задания
+BATCH_DONE_STATES = {
+    genai_types.JobState.JOB_STATE_SUCCEEDED,
+    genai_types.JobState.JOB_STATE_FAILED,
+    genai_types.JobState.JOB_STATE_CANCELLED,
+    genai_types.JobState.JOB_STATE_EXPIRED,
+}
+
+# Права новых файлов по умолчанию - как у open() с текущей umask процесса
+# (umask читается один раз при импорте: os.umask меняет её для всех потоков)
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+DEFAULT_FILE_MODE = 0o666 & ~_UMASK
+
+# Кэш ответов File Agent: версия формата ключа и максимальный размер
+CACHE_VERSION = "v3"
+CACHE_MAX_SIZE = 1024
+
+# Постоянные инструкции агентов идут первыми, а переменные части запроса
+# (команда, список файлов, содержимое) - в конце, чтобы префикс запроса
+# совпадал между вызовами и попадал в кэш контекста Gemini
+SUPERVISOR_SYSTEM = """Ты - Supervisor Agent в multi-agent системе редактирования файлов.
+
+По команде пользователя и списку доступных файлов определи, какие файлы нужно обработать, и сформулируй задачу для каждого из них.
+Ответь ТОЛЬКО JSON-массивом вида [{"file": "имя файла", "instruction": "задача для файла"}].
+Каждый файл указывай в массиве не более одного раза: если для файла несколько задач, объедини их в одну instruction.
+Формулируй instruction на языке команды пользователя и по возможности сохраняй её формулировку.
+Если обрабатывать нечего или команда неясна, верни пустой массив []."""
+
+FILE_AGENT_SYSTEM = """Ты - File Agent, специализирующийся на редактировании одного файла.
+
+Тебе передают имя файла и команду пользователя, а следующей частью сообщения - текущее содержимое файла (если её нет, файл пуст).
+Выполни необходимые изменения и верни ТОЛЬКО обновлённое содержимое файла, без дополнительных комментариев."""
+
+# Шаблоны переменной части запросов агентов
+SUPERVISOR_TMPL = Template("""Команда пользователя: $command
+
+Доступные файлы: $files""")
+
+FILE_AGENT_TMPL = Template("""Файл: $file
+
+Команда пользователя: $command""")
+
+
+# Быстрые правила: простые детерминированные команды выполняются без LLM.
+# Преобразование получает совпадение, имя файла и содержимое и возвращает
+# новое содержимое или None, если правило к файлу неприменимо
+FastRuleTransform = Callable[[re.Match, str, str], Optional[str]]
+
+# Префиксы однострочных комментариев по расширению файла
+COMMENT_PREFIXES = {
+    ".py": "#", ".sh": "#", ".rb": "#", ".yml": "#", ".yaml": "#", ".toml": "#",
+    ".js": "//", ".ts": "//", ".jsx": "//", ".tsx": "//", ".java": "//",
+    ".c": "//", ".h": "//", ".cpp": "//", ".cs": "//", ".go": "//", ".rs": "//",
+    ".sql": "--", ".txt": "", ".md": "",
+}
+
+
+def _add_todo_comment(match: re.Match, filename: str, content: str) -> Optional[str]:
+    """
+    Добавление TODO-комментария в конец файла с учётом синтаксиса комментариев
+    """
+    prefix = COMMENT_PREFIXES.get(os.path.splitext(filename)[1].lower())
+    if prefix is None:
+        return None
+    todo = f"{prefix} TODO" if prefix else "TODO"
+    if content and not content.endswith("\n"):
+        content += "\n"
+    return f"{content}{todo}\n"
+
+
+def _rename_identifier(match: re.Match, filename: str, content: str) -> Optional[str]:
+    """
+    Переименование идентификатора (только целые слова)
+    """
+    old, new = match.group("old"), match.group("new")
+    return re.sub(rf"\b{re.escape(old)}\b", new, content)
+
+
+def _remove_blank_lines(match: re.Match, filename: str, content: str) -> Optional[str]:
+    """
+    Удаление пустых строк и строк из одних пробелов
+    """
+    return "".join(line for line in content.splitlines(keepends=True) if line.strip())
+
+
+# Необязательная цель команды - имя файла ("... to main.py", "... в main.py").
+# Правило применяется, только если цели нет или она совпадает с именем файла;
+# цель другого вида ("to main()") не подходит под правило, и команду выполняет LLM
+_QUOTE = r"[\"'`]?"
+_TARGET = rf"{_QUOTE}(?P<target>[\w.-]+?){_QUOTE}"
+
+# Правила на английском и русском: instruction от Supervisor может прийти
+# на любом из этих языков
+FAST_RULES: List[Tuple[re.Pattern, FastRuleTransform]] = [
+    (
+        re.compile(rf"add (?:a )?todo comment(?: (?:to|in) {_TARGET})?\.?", re.I),
+        _add_todo_comment,
+    ),
+    (
+        re.compile(
+            rf"добав(?:ь|ить) (?:комментарий )?todo(?:[- ]комментарий)?(?: в {_TARGET})?\.?",
+            re.I,
+        ),
+        _add_todo_comment,
+    ),
+    (
+        re.compile(
+            rf"rename {_QUOTE}(?P<old>\w+){_QUOTE} to {_QUOTE}(?P<new>\w+){_QUOTE}"
+            rf"(?: in {_TARGET})?\.?",
+            re.I,
+        ),
+        _rename_identifier,
+    ),
+    (
+        re.compile(
+            rf"переимен(?:уй|овать) {_QUOTE}(?P<old>\w+){_QUOTE} в {_QUOTE}(?P<new>\w+){_QUOTE}"
+            rf"(?: в {_TARGET})?\.?",
+            re.I,
+        ),
+        _rename_identifier,
+    ),
+    (
+        re.compile(rf"remove (?:all )?(?:blank|empty) lines(?: (?:from|in) {_TARGET})?\.?", re.I),
+        _remove_blank_lines,
+    ),
+    (
+        re.compile(rf"удал(?:и|ить) (?:все )?пустые строки(?: (?:из|в) {_TARGET})?\.?", re.I),
+        _remove_blank_lines,
+    ),
+]
+
+
+# Markdown обёртка ответа LLM: ```lang ... ``` вокруг всего текста
+_FENCE_RE = re.compile(r"\A```[^\n]*\n(.*?)\n```\s*\Z", re.DOTALL)
+
+
+# Callback, вызываемый по завершении обработки каждого файла:
+# on_file(filename, content, message), content - None при ошибке
+FileCallback = Callable[[str, Optional[str], str], Awaitable[None]]
+
+# Callback для потоковой передачи ответа File Agent: on_chunk(filename, delta)
+ChunkCallback = Callable[[str, str], Awaitable[None]]
 
 
 # Состояние графа
 class AgentState(TypedDict):
-    messages: Annotated[List[BaseMessage], operator.add]
-    current_file: str
+    messages: Annotated[List[BaseMessage], add_messages]
     files: Dict[str, str]  # {filename: content}
     command: str
+    plan: List[Dict[str, str]]  # [{"file": ..., "instruction": ...}]
+    tier: str  # уровень обслуживания Gemini: standard, priority или flex
     result: str
 
 
 class MultiAgentSystem:
-    def __init__(self, api_key: str = None):
+    def __init__(self, api_key: str = None, max_workers: int = MAX_WORKERS):
         """
         Инициализация multi-agent системы
         
         Args:
             api_key: Google Gemini API ключ
+            max_workers: максимальное число файлов, обрабатываемых одновременно
         """
         self.api_key = api_key or os.getenv("GOOGLE_API_KEY")
         if not self.api_key:
             raise ValueError("GOOGLE_API_KEY не установлен")
         
-        # Инициализация LLM
+        # Инициализация LLM для File Agents: temperature=0 делает ответы
+        # детерминированными, что позволяет их кэшировать
         self.llm = ChatGoogleGenerativeAI(
-            model="gemini-2.0-flash-exp",
+            model=MODEL_NAME,
             google_api_key=self.api_key,
-            temperature=0.3
+            temperature=0,
+            top_p=1,
+            max_output_tokens=MAX_OUTPUT_TOKENS
         )
         
-        # Граф агентов
-        self.workflow = self._create_workflow()
+        # Клиент Gemini API для batch-заданий: используем клиент LLM, чтобы
+        # все запросы шли через одно HTTP-соединение
+        self.genai_client = self.llm.client
+        
+        # Кэш ответов File Agent: {sha256(model, filename, command, content): updated_content}
+        self._cache: OrderedDict[str, str] = OrderedDict()
+        
+        # Правила для простых команд, которые выполняются без LLM,
+        # и статистика их срабатывания
+        self._fast_rules: List[Tuple[re.Pattern, FastRuleTransform]] = list(FAST_RULES)
+        self._fast_hits = 0
+        self._fast_misses = 0
+        
+        # Отправленные batch-задания, результаты которых ещё не получены:
+        # {job_name: (state, [(filename, cache_key), ...])}
+        self._batch_jobs: Dict[str, Tuple[AgentState, List[Tuple[str, str]]]] = {}
+        
+        # Хэши файлов на диске: {filename: (st_mtime_ns, st_size, sha256)}
+        self._content_hash: Dict[str, Tuple[int, int, bytes]] = {}
+        
+        # LLM для планирования: тот же клиент и те же параметры выборки
+        # (temperature=0, top_p=1, маршрутизация детерминирована),
+        # но ответ строго в формате JSON
+        self.planner_llm = self.llm.bind(response_mime_type="application/json")
+        
+        # Максимальное число одновременных запросов File Agents
+        self.max_workers = max_workers
+        
+        # Граф агентов с checkpoint; создаётся только при первом запросе
+        # с checkpoint=True, обычные команды выполняются через _run
+        self._workflow = None
+    
+    @property
+    def workflow(self):
+        """
+        LangGraph workflow с сохранением состояния (создаётся при первом обращении)
+        """
+        if self._workflow is None:
+            self._workflow = self._create_workflow()
+        return self._workflow
     
     def _create_workflow(self) -> StateGraph:
         """
@@ -52,32 +273,52 @@ class MultiAgentSystem:
         workflow = StateGraph(AgentState)
         
         # Узлы графа
-        workflow.add_node("supervisor", self.supervisor_node)
+        workflow.add_node("plan", self.plan_node)
         workflow.add_node("file_agent", self.file_agent_node)
         workflow.add_node("finalize", self.finalize_node)
         
         # Рёбра графа
-        workflow.set_entry_point("supervisor")
+        workflow.set_entry_point("plan")
         
-        # Supervisor решает: обработать файл или завершить
+        # План пуст - сразу завершаем, иначе обрабатываем файлы
         workflow.add_conditional_edges(
-            "supervisor",
-            self.route_supervisor,
+            "plan",
+            self.route_plan,
             {
                 "file_agent": "file_agent",
                 "finalize": "finalize"
             }
         )
         
-        # После обработки файла возвращаемся к Supervisor
-        workflow.add_edge("file_agent", "supervisor")
+        # Все файлы обрабатываются параллельно за один проход
+        workflow.add_edge("file_agent", "finalize")
         workflow.add_edge("finalize", END)
         
-        return workflow.compile()
+        return workflow.compile(checkpointer=MemorySaver())
+    
+    async def _run(self, state: AgentState, config: RunnableConfig) -> AgentState:
+        """
+        Выполнение тех же узлов, что и в workflow, обычным async-циклом
+        без накладных расходов графа
+        """
+        state = self._merge(state, await self.plan_node(state))
+        if self.route_plan(state) == "file_agent":
+            state = self._merge(state, await self.file_agent_node(state, config))
+        return self._merge(state, self.finalize_node(state))
     
-    def supervisor_node(self, state: AgentState) -> AgentState:
+    @staticmethod
+    def _merge(state: AgentState, update: Dict) -> AgentState:
         """
-        Supervisor Agent: анализирует команду и решает, какой файл обработать
+        Применение обновления узла к состоянию так же, как это делает LangGraph
+        """
+        merged = {**state, **update}
+        if "messages" in update:
+            merged["messages"] = add_messages(state["messages"], update["messages"])
+        return merged
+    
+    async def plan_node(self, state: AgentState) -> Dict:
+        """
+        Supervisor Agent: за один вызов LLM составляет план обработки файлов
         """
         messages = state["messages"]
         command = state.get("command", "")
@@ -87,133 +328,581 @@ class MultiAgentSystem:
             # Первый вызов - получаем команду из последнего сообщения
             if messages and isinstance(messages[-1], HumanMessage):
                 command = messages[-1].content
-                state["command"] = command
         
-        # Supervisor определяет, какой файл нужно обработать
-        prompt = f"""Ты - Supervisor Agent в multi-agent системе редактирования файлов.
-
-Команда пользователя: {command}
-
-Доступные файлы: {list(files.keys())}
-
-Определи:
-1. Какой файл нужно обработать (верни только имя файла)
-2. Если все файлы обработаны или команда неясна, верни "DONE"
-
-Ответь ТОЛЬКО именем файла или DONE, без дополнительного текста."""
+        # Простая команда для одного файла не требует планирования
+        plan = self._fast_plan(command, files)
+        
+        if plan is None:
+            # Supervisor сразу определяет все файлы, которые нужно обработать
+            prompt = SUPERVISOR_TMPL.substitute(command=command, files=", ".join(files))
+            
+            response = await self.planner_llm.ainvoke([
+                SystemMessage(content=SUPERVISOR_SYSTEM),
+                HumanMessage(content=prompt)
+            ], service_tier=state["tier"])
+            plan = self._parse_plan(response.content)
+        
+        return {
+            "command": command,
+            "plan": plan,
+            "messages": [
+                AIMessage(
+                    content=f"Supervisor: выбраны файлы {[step['file'] for step in plan]}"
+                )
+            ]
+        }
+    
+    async def file_agent_node(self, state: AgentState, config: RunnableConfig) -> Dict:
+        """
+        File Agents: параллельно обрабатывают все выбранные файлы
+        """
+        files = state["files"]
+        semaphore = asyncio.Semaphore(self.max_workers)
+        configurable = config.get("configurable", {})
+        on_file: Optional[FileCallback] = configurable.get("on_file")
+        on_chunk: Optional[ChunkCallback] = configurable.get("on_chunk")
         
-        response = self.llm.invoke([HumanMessage(content=prompt)])
-        target_file = response.content.strip()
+        async def run(filename: str, command: str) -> str:
+            # Ошибка одного файла (например, 429/503 от API) не прерывает
+            # обработку остальных и попадает в сообщения как результат файла
+            content = None
+            async with semaphore:
+                try:
+                    ok, message = await self._edit_file(
+                        filename, command, files, state["tier"], on_chunk
+                    )
+                    if ok:
+                        content = files[filename]
+                except Exception as e:
+                    print(f"Ошибка обработки файла {filename}: {e}")
+                    message = f"Ошибка обработки файла '{filename}': {e}"
+            if on_file is not None:
+                await on_file(filename, content, message)
+            return message
         
-        state["current_file"] = target_file
-        state["messages"].append(
-            AIMessage(content=f"Supervisor: выбран файл '{target_file}'")
+        results = await asyncio.gather(
+            *[run(step["file"], step["instruction"]) for step in state["plan"]]
         )
         
-        return state
+        return {
+            "files": files,
+            "messages": [AIMessage(content=result) for result in results]
+        }
     
-    def file_agent_node(self, state: AgentState) -> AgentState:
+    async def _edit_file(
+        self,
+        filename: str,
+        command: str,
+        files: Dict[str, str],
+        tier: str = "standard",
+        on_chunk: Optional[ChunkCallback] = None
+    ) -> Tuple[bool, str]:
         """
-        File Agent: обрабатывает конкретный файл согласно команде
+        File Agent: обрабатывает конкретный файл согласно команде.
+        Ответ LLM читается потоком; каждый фрагмент передаётся в on_chunk.
+        
+        Returns:
+            Признак успешного обновления файла и сообщение о результате
         """
-        current_file = state["current_file"]
-        command = state["command"]
-        files = state["files"]
+        if filename not in files:
+            return False, f"Ошибка: файл '{filename}' не найден"
         
-        if current_file not in files:
-            state["messages"].append(
-                AIMessage(content=f"Ошибка: файл '{current_file}' не найден")
-            )
-            return state
+        file_content = files[filename]
+        cache_key = self._cache_key(filename, command, file_content)
         
-        file_content = files[current_file]
+        result = await self._edit_without_llm(filename, command, files, cache_key)
+        if result is not None:
+            return result
         
         # File Agent применяет изменения к файлу
-        prompt = f"""Ты - File Agent, специализирующийся на редактировании файла '{current_file}'.
-
-Текущее содержимое файла:
-```
-{file_content}
-```
-
-Команда пользователя: {command}
-
-Выполни необходимые изменения и верни ТОЛЬКО обновлённое содержимое файла, без дополнительных комментариев."""
+        messages = [
+            SystemMessage(content=FILE_AGENT_SYSTEM),
+            HumanMessage(content=[
+                {"type": "text", "text": part}
+                for part in self._file_agent_parts(filename, command, file_content)
+            ])
+        ]
+        chunks = []
+        finish_reason = None
+        async for chunk in self.llm.astream(
+            messages,
+            service_tier=tier,
+            max_output_tokens=self._output_token_cap(file_content),
+            thinking_budget=0
+        ):
+            chunks.append(chunk.content)
+            finish_reason = chunk.response_metadata.get("finish_reason", finish_reason)
+            if on_chunk is not None and chunk.content:
+                await on_chunk(filename, chunk.content)
         
-        response = self.llm.invoke([HumanMessage(content=prompt)])
-        updated_content = response.content.strip()
+        return await self._apply_response(
+            filename, chunks, finish_reason == "MAX_TOKENS", files, cache_key
+        )
+    
+    async def _edit_without_llm(
+        self, filename: str, command: str, files: Dict[str, str], cache_key: str
+    ) -> Optional[Tuple[bool, str]]:
+        """
+        Выполнение команды для файла без запроса к LLM: по быстрому правилу
+        или из кэша ответов
         
-        # Удаляем markdown обёртку, если есть
-        if updated_content.startswith("```"):
-            lines = updated_content.split("\n")
-            updated_content = "\n".join(lines[1:-1]) if len(lines) > 2 else updated_content
+        Returns:
+            Результат как у _edit_file или None, если нужен запрос к LLM
+        """
+        fast_content = self._apply_fast_rules(filename, command, files[filename])
+        if fast_content is not None:
+            await self._apply_update(filename, fast_content, files)
+            return True, f"File Agent: файл '{filename}' обновлён (без LLM)"
         
-        # Обновляем содержимое файла
-        files[current_file] = updated_content
-        state["files"] = files
+        cached = self._cache_get(cache_key)
+        if cached is not None:
+            await self._apply_update(filename, cached, files)
+            return True, f"File Agent: файл '{filename}' обновлён (из кэша)"
         
-        state["messages"].append(
-            AIMessage(content=f"File Agent: файл '{current_file}' обновлён")
-        )
+        return None
+    
+    async def _apply_response(
+        self,
+        filename: str,
+        chunks: List[str],
+        truncated: bool,
+        files: Dict[str, str],
+        cache_key: str
+    ) -> Tuple[bool, str]:
+        """
+        Применение ответа LLM (потокового или из batch-задания) к файлу
+        
+        Returns:
+            Результат как у _edit_file
+        """
+        # Обрезанный ответ - это неполный файл, его нельзя сохранять
+        if truncated:
+            return False, f"Ошибка: ответ для файла '{filename}' превысил лимит токенов"
         
-        # Сохраняем изменения на диск
-        self._save_file(current_file, updated_content)
+        # Разбор ответа и запись на диск - в пуле потоков, чтобы большие
+        # файлы не блокировали event loop (и WebSocket)
+        updated_content = await asyncio.to_thread(self._postprocess, filename, chunks)
+        files[filename] = updated_content
+        self._cache_put(cache_key, updated_content)
         
-        return state
+        return True, f"File Agent: файл '{filename}' обновлён"
     
-    def finalize_node(self, state: AgentState) -> AgentState:
+    def _apply_fast_rules(self, filename: str, command: str, file_content: str) -> Optional[str]:
         """
-        Финализация: подготовка результата
+        Выполнение простой команды без LLM, если она подходит под одно из правил
+        
+        Returns:
+            Обновлённое содержимое файла или None, если команду должна выполнить LLM
         """
-        state["result"] = "Обработка завершена"
-        state["messages"].append(
-            AIMessage(content="Все файлы обработаны. Задача выполнена.")
+        updated_content = None
+        for pattern, transform in self._fast_rules:
+            match = pattern.fullmatch(command.strip())
+            if match and self._rule_target(match) in (None, filename):
+                updated_content = transform(match, filename, file_content)
+                if updated_content is not None:
+                    break
+        
+        if updated_content is None:
+            self._fast_misses += 1
+            return None
+        
+        self._fast_hits += 1
+        total = self._fast_hits + self._fast_misses
+        print(
+            f"Fast path: '{command}' для {filename} выполнена без LLM "
+            f"({self._fast_hits}/{total} команд)"
         )
-        return state
+        return updated_content
     
-    def route_supervisor(self, state: AgentState) -> str:
+    def _fast_plan(self, command: str, files: Dict[str, str]) -> Optional[List[Dict[str, str]]]:
         """
-        Маршрутизация: определяет следующий шаг после Supervisor
+        План без вызова LLM для команды, подходящей под быстрое правило:
+        команда целиком передаётся файлу, указанному в ней, или единственному
+        файлу запроса
+        
+        Returns:
+            План из одного шага или None, если план должен составить Supervisor
+        """
+        for pattern, _ in self._fast_rules:
+            match = pattern.fullmatch(command.strip())
+            if not match:
+                continue
+            target = self._rule_target(match)
+            if target is None and len(files) == 1:
+                target = next(iter(files))
+            if target in files:
+                return [{"file": target, "instruction": command}]
+        return None
+    
+    @staticmethod
+    def _rule_target(match: re.Match) -> Optional[str]:
+        """
+        Имя файла, указанное в команде быстрого правила; None, если его нет
+        """
+        return match.groupdict().get("target")
+    
+    @staticmethod
+    def _output_token_cap(file_content: str) -> int:
         """
-        current_file = state.get("current_file", "")
+        Лимит токенов ответа File Agent по размеру файла: примерно 4 символа
+        на токен, с запасом вдвое на добавляемый текст
+        """
+        return min(MAX_OUTPUT_TOKENS, max(MIN_OUTPUT_TOKENS, len(file_content) // 2))
+    
+    @staticmethod
+    def _file_agent_parts(filename: str, command: str, file_content: str) -> List[str]:
+        """
+        Переменная часть запроса File Agent (идёт после FILE_AGENT_SYSTEM):
+        описание задачи и содержимое файла отдельными частями сообщения,
+        чтобы не оборачивать содержимое в markdown. Пустой файл не передаётся.
+        """
+        header = FILE_AGENT_TMPL.substitute(file=filename, command=command)
+        return [header, file_content] if file_content else [header]
+    
+    @staticmethod
+    def _strip_fences(text: str) -> str:
+        """
+        Удаление markdown обёртки из ответа LLM, если она есть
+        """
+        text = text.strip()
+        match = _FENCE_RE.match(text)
+        if match:
+            text = match.group(1)
+        return text
+    
+    def _postprocess(self, filename: str, chunks: List[str]) -> str:
+        """
+        Сборка ответа LLM, удаление markdown обёртки и сохранение файла на диск.
+        Выполняется в пуле потоков.
         
-        if current_file == "DONE" or not current_file:
+        Returns:
+            Обновлённое содержимое файла
+        """
+        updated_content = self._strip_fences("".join(chunks))
+        self._save_file(filename, updated_content)
+        return updated_content
+    
+    async def _apply_update(self, filename: str, updated_content: str, files: Dict[str, str]):
+        """
+        Обновление содержимого файла в состоянии и на диске (запись - в пуле потоков)
+        """
+        files[filename] = updated_content
+        await asyncio.to_thread(self._save_file, filename, updated_content)
+    
+    def finalize_node(self, state: AgentState) -> Dict:
+        """
+        Финализация: подготовка результата
+        """
+        return {
+            "result": "Обработка завершена",
+            "messages": [AIMessage(content="Все файлы обработаны. Задача выполнена.")]
+        }
+    
+    def route_plan(self, state: AgentState) -> str:
+        """
+        Маршрутизация: определяет следующий шаг по готовому плану, без вызова LLM
+        """
+        if not state.get("plan"):
             return "finalize"
         return "file_agent"
     
+    @staticmethod
+    def _parse_plan(text: str) -> List[Dict[str, str]]:
+        """
+        Разбор ответа Supervisor: JSON-массив [{"file": ..., "instruction": ...}].
+        Несколько шагов для одного файла объединяются в один: параллельные
+        агенты правили бы одно и то же исходное содержимое, и сохранилась бы
+        только последняя правка.
+        """
+        try:
+            data = json.loads(text)
+        except json.JSONDecodeError:
+            return []
+        
+        if not isinstance(data, list):
+            return []
+        
+        # {filename: [instruction, ...]} в порядке первого упоминания файла
+        instructions: Dict[str, List[str]] = {}
+        for step in data:
+            if isinstance(step, dict) and "file" in step and "instruction" in step:
+                instructions.setdefault(str(step["file"]), []).append(str(step["instruction"]))
+        
+        return [
+            {"file": filename, "instruction": "\n".join(steps)}
+            for filename, steps in instructions.items()
+        ]
+    
+    def _cache_key(self, filename: str, command: str, file_content: str) -> str:
+        """
+        Ключ кэша ответов File Agent; пустая строка, если ответы не детерминированы.
+        Имя файла входит в ключ, так как оно передаётся в запросе File Agent.
+        """
+        if self.llm.temperature != 0:
+            return ""
+        raw = f"{self.llm.model}|{CACHE_VERSION}|{filename}|{command}|{file_content}"
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+    
+    def _cache_get(self, cache_key: str) -> Optional[str]:
+        """
+        Получение ответа из кэша; None, если записи нет
+        """
+        if cache_key not in self._cache:
+            return None
+        self._cache.move_to_end(cache_key)
+        return self._cache[cache_key]
+    
+    def _cache_put(self, cache_key: str, updated_content: str):
+        """
+        Сохранение ответа в кэш с вытеснением самых старых записей
+        """
+        if not cache_key:
+            return
+        self._cache[cache_key] = updated_content
+        self._cache.move_to_end(cache_key)
+        while len(self._cache) > CACHE_MAX_SIZE:
+            self._cache.popitem(last=False)
+    
     def _save_file(self, filename: str, content: str):
         """
-        Сохранение файла на диск
+        Сохранение файла на диск. Если содержимое не изменилось, запись
+        пропускается; иначе файл заменяется атомарно через временный файл
+        (у каждой записи свой) с правами исходного файла.
         """
-        file_path = os.path.join("/app/files", filename)
+        file_path = Path(FILES_DIR) / filename
+        data = content.encode("utf-8")
+        digest = hashlib.sha256(data).digest()
         try:
-            with open(file_path, "w", encoding="utf-8") as f:
-                f.write(content)
+            if self._disk_hash(file_path) == digest:
+                return
+            
+            fd, tmp_name = tempfile.mkstemp(
+                dir=file_path.parent, prefix=f".{file_path.name}.", suffix=".tmp"
+            )
+            tmp_path = Path(tmp_name)
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    f.write(data)
+                    os.fchmod(f.fileno(), file_mode(file_path))
+                os.replace(tmp_path, file_path)
+            finally:
+                # После успешной замены временного файла уже нет
+                tmp_path.unlink(missing_ok=True)
+            
+            stat = file_path.stat()
+            self._content_hash[file_path.name] = (stat.st_mtime_ns, stat.st_size, digest)
         except Exception as e:
             print(f"Ошибка сохранения файла {filename}: {e}")
     
-    def process_command(self, command: str, files: Dict[str, str]) -> Dict:
+    def _disk_hash(self, file_path: Path) -> Optional[bytes]:
+        """
+        SHA-256 текущего содержимого файла на диске; None, если файла нет.
+        Хэш пересчитывается, только если изменились mtime или размер файла.
+        """
+        try:
+            stat = file_path.stat()
+        except FileNotFoundError:
+            return None
+        
+        cached = self._content_hash.get(file_path.name)
+        if cached and cached[:2] == (stat.st_mtime_ns, stat.st_size):
+            return cached[2]
+        
+        digest = hashlib.sha256(file_path.read_bytes()).digest()
+        self._content_hash[file_path.name] = (stat.st_mtime_ns, stat.st_size, digest)
+        return digest
+    
+    async def process_command(
+        self,
+        command: str,
+        files: Dict[str, str],
+        tier: str = "standard",
+        on_file: Optional[FileCallback] = None,
+        on_chunk: Optional[ChunkCallback] = None,
+        checkpoint: bool = False,
+        thread_id: Optional[str] = None
+    ) -> Dict:
         """
         Обработка команды пользователя
         
         Args:
             command: команда от пользователя
             files: словарь {filename: content}
+            tier: уровень обслуживания Gemini (один из SERVICE_TIERS)
+            on_file: callback, вызываемый сразу после обработки каждого файла
+            on_chunk: callback для фрагментов ответа File Agent по мере генерации
+            checkpoint: выполнить команду через LangGraph workflow с сохранением
+                состояния (MemorySaver) под идентификатором thread_id
+            thread_id: идентификатор сессии для checkpoint (обязателен при
+                checkpoint=True, чтобы история разных сессий не смешивалась)
         
         Returns:
             Результат обработки
         """
+        if tier not in SERVICE_TIERS:
+            raise ValueError(f"Неизвестный уровень обслуживания: {tier}")
+        if checkpoint and not thread_id:
+            raise ValueError("Для checkpoint=True нужно указать thread_id")
+        
         initial_state = AgentState(
             messages=[HumanMessage(content=command)],
-            current_file="",
             files=files,
             command=command,
+            plan=[],
+            tier=tier,
             result=""
         )
         
-        # Запускаем workflow
-        final_state = self.workflow.invoke(initial_state)
+        config = {"configurable": {"on_file": on_file, "on_chunk": on_chunk}}
+        
+        if checkpoint:
+            # Запускаем workflow
+            config["configurable"]["thread_id"] = thread_id
+            final_state = await self.workflow.ainvoke(initial_state, config=config)
+        else:
+            final_state = await self._run(initial_state, config)
+        
+        return self._build_result(final_state)
+    
+    async def process_command_batch(self, command: str, files: Dict[str, str]) -> Dict:
+        """
+        Обработка команды через Gemini Batch API: все запросы File Agents
+        отправляются одним batch-заданием (дешевле, но без гарантий по задержке).
+        Метод не ждёт завершения задания: файлы, обработанные без LLM, обновляются
+        сразу, остальные - при получении результата через collect_batch.
+        
+        Args:
+            command: команда от пользователя
+            files: словарь {filename: content}
+        
+        Returns:
+            Результат обработки (в том же формате, что и process_command);
+            если задание отправлено - status "pending" и имя задания в "job"
+        """
+        # Для одного файла batch-задание не даёт выигрыша
+        if len(files) <= 1:
+            return await self.process_command(command, files)
+        
+        state = AgentState(
+            messages=[HumanMessage(content=command)],
+            files=files,
+            command=command,
+            plan=[],
+            tier="standard",
+            result=""
+        )
+        state = self._merge(state, await self.plan_node(state))
+        
+        # Файлы, которые нужно отправить в batch-задание: [(filename, cache_key)]
+        pending = []
+        requests = []
+        for step in state["plan"]:
+            filename, instruction = step["file"], step["instruction"]
+            if filename not in files:
+                state["messages"].append(
+                    AIMessage(content=f"Ошибка: файл '{filename}' не найден")
+                )
+                continue
+            
+            cache_key = self._cache_key(filename, instruction, files[filename])
+            result = await self._edit_without_llm(filename, instruction, files, cache_key)
+            if result is not None:
+                state["messages"].append(AIMessage(content=result[1]))
+                continue
+            
+            pending.append((filename, cache_key))
+            requests.append({
+                "contents": [{
+                    "role": "user",
+                    "parts": [
+                        {"text": part}
+                        for part in self._file_agent_parts(filename, instruction, files[filename])
+                    ]
+                }],
+                "config": {
+                    "system_instruction": FILE_AGENT_SYSTEM,
+                    "temperature": self.llm.temperature,
+                    "top_p": self.llm.top_p,
+                    "max_output_tokens": self._output_token_cap(files[filename]),
+                    "thinking_config": {"thinking_budget": 0}
+                }
+            })
+        
+        if not requests:
+            return self._build_result(self._merge(state, self.finalize_node(state)))
+        
+        job = await self.genai_client.aio.batches.create(
+            model=MODEL_NAME,
+            src=requests,
+            config={"display_name": "multi-agent-file-editor"}
+        )
+        self._batch_jobs[job.name] = (state, pending)
         
+        return {
+            **self._build_result(state),
+            "status": "pending",
+            "result": f"Batch-задание отправлено, файлов в обработке: {len(pending)}",
+            "job": job.name
+        }
+    
+    async def collect_batch(self, job_name: str) -> Dict:
+        """
+        Получение результата batch-задания, отправленного process_command_batch
+        
+        Args:
+            job_name: имя задания из ответа process_command_batch
+        
+        Returns:
+            status "pending", пока задание выполняется; затем - результат
+            обработки (в том же формате, что и process_command)
+        
+        Raises:
+            KeyError: задание неизвестно или его результат уже получен
+        """
+        if job_name not in self._batch_jobs:
+            raise KeyError(job_name)
+        
+        job = await self.genai_client.aio.batches.get(name=job_name)
+        if job.state not in BATCH_DONE_STATES:
+            return {"status": "pending", "job": job_name, "state": job.state.name}
+        
+        # Результат получает только один из одновременных запросов
+        entry = self._batch_jobs.pop(job_name, None)
+        if entry is None:
+            raise KeyError(job_name)
+        state, pending = entry
+        
+        responses = []
+        if job.state == genai_types.JobState.JOB_STATE_SUCCEEDED and job.dest is not None:
+            responses = job.dest.inlined_responses or []
+        
+        for i, (filename, cache_key) in enumerate(pending):
+            response = responses[i] if i < len(responses) else None
+            if response is None:
+                message = (
+                    f"Ошибка обработки файла '{filename}': batch-задание {job_name} "
+                    f"завершилось со статусом {job.state.name} без ответа для файла"
+                )
+            elif response.error or response.response is None:
+                message = f"Ошибка обработки файла '{filename}': {response.error}"
+            else:
+                candidates = response.response.candidates or []
+                truncated = bool(candidates) and (
+                    candidates[0].finish_reason == genai_types.FinishReason.MAX_TOKENS
+                )
+                _, message = await self._apply_response(
+                    filename, [response.response.text or ""], truncated,
+                    state["files"], cache_key
+                )
+            state["messages"].append(AIMessage(content=message))
+        
+        return self._build_result(self._merge(state, self.finalize_node(state)))
+    
+    @staticmethod
+    def _build_result(final_state: AgentState) -> Dict:
+        """
+        Формирование ответа API из итогового состояния
+        """
         return {
             "status": "success",
             "result": final_state.get("result", ""),
@@ -226,15 +915,78 @@ class MultiAgentSystem:
         }
 
 
+def check_filename(name) -> None:
+    """
+    Проверка имени файла из запроса: только имя файла в FILES_DIR, без пути
+    (в том числе за пределы FILES_DIR). Имена с точкой в начале заняты
+    временными файлами незавершённых записей.
+    
+    Raises:
+        ValueError: имя файла недопустимо
+    """
+    if (
+        not isinstance(name, str)
+        or not name
+        or name.startswith(".")
+        or any(c in name for c in "/\\\0")
+    ):
+        raise ValueError(f"Недопустимое имя файла: {name!r}")
+
+
+def file_mode(file_path) -> int:
+    """
+    Права для новой версии файла: как у существующего файла
+    или DEFAULT_FILE_MODE, если файла ещё нет
+    """
+    try:
+        return os.stat(file_path).st_mode & 0o7777
+    except FileNotFoundError:
+        return DEFAULT_FILE_MODE
+
+
+def load_files(filenames: List[str]) -> Dict[str, str]:
+    """
+    Чтение файлов из FILES_DIR по именам. Файлы отображаются в память (mmap)
+    и декодируются прямо из страничного кэша ОС, без промежуточной копии.
+    
+    Args:
+        filenames: имена файлов в FILES_DIR
+    
+    Returns:
+        Словарь {filename: content}
+    
+    Raises:
+        ValueError: filenames - не список или имя файла недопустимо (check_filename)
+    """
+    if not isinstance(filenames, list):
+        raise ValueError("filenames должен быть списком имён файлов")
+    for name in filenames:
+        check_filename(name)
+    
+    files = {}
+    for name in filenames:
+        with open(os.path.join(FILES_DIR, name), "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                files[name] = ""
+                continue
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                files[name] = str(mm, "utf-8")
+    return files
+
+
 # Глобальный экземпляр (инициализируется при первом использовании)
 _agent_system: MultiAgentSystem = None
+_agent_lock = threading.Lock()
 
 
 def get_agent_system() -> MultiAgentSystem:
     """
-    Получить экземпляр multi-agent системы (singleton)
+    Получить экземпляр multi-agent системы (singleton).
+    Потокобезопасно: при одновременных первых вызовах система создаётся один раз.
     """
     global _agent_system
     if _agent_system is None:
-        _agent_system = MultiAgentSystem()
+        with _agent_lock:
+            if _agent_system is None:
+                _agent_system = MultiAgentSystem()
     return _agent_system
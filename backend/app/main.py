@@ -1,12 +1,84 @@
-from fastapi import FastAPI, UploadFile, File, WebSocket, WebSocketDisconnect
+from fastapi import FastAPI, HTTPException, UploadFile, File, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
-from typing import List
+from fastapi.responses import JSONResponse
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from typing import Dict, List, Tuple
+import asyncio
 import os
-import shutil
-import json
-from .agents import get_agent_system
+import tempfile
+import uuid
+import orjson
+from .agents import check_filename, file_mode, get_agent_system, load_files
 
-app = FastAPI(title="Multi-Agent File Editor")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Создание multi-agent системы при старте приложения, чтобы инициализация
+    клиента Gemini не попадала во время обработки первого запроса.
+    Общий пул потоков ограничивает число одновременных файловых операций
+    (asyncio.to_thread), вынесенных из event loop.
+    """
+    asyncio.get_running_loop().set_default_executor(
+        ThreadPoolExecutor(max_workers=THREAD_POOL_SIZE)
+    )
+    
+    try:
+        get_agent_system()
+    except ValueError as e:
+        print(f"Multi-agent система не инициализирована: {e}")
+    yield
+
+
+app = FastAPI(title="Multi-Agent File Editor", lifespan=lifespan)
+
+
+class UploadSizeLimitMiddleware:
+    """
+    Ограничение размера тела запроса /upload до разбора multipart-формы:
+    иначе Starlette сначала целиком сохранит запрос во временные файлы
+    на диске. Запрос с большим Content-Length отклоняется сразу, а у
+    запросов без него (chunked) считаются полученные байты.
+    Остальные запросы проходят без изменений.
+    """
+    
+    def __init__(self, app):
+        self.app = app
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] != "/upload":
+            await self.app(scope, receive, send)
+            return
+        
+        too_large = HTTPException(
+            status_code=413,
+            detail=f"Total upload size must be at most {MAX_TOTAL_BYTES} bytes"
+        )
+        
+        content_length = dict(scope["headers"]).get(b"content-length")
+        if content_length is not None and (
+            not content_length.isdigit() or int(content_length) > MAX_UPLOAD_BODY
+        ):
+            response = JSONResponse(status_code=413, content={"detail": too_large.detail})
+            await response(scope, receive, send)
+            return
+        
+        received = 0
+        
+        async def receive_limited():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > MAX_UPLOAD_BODY:
+                    raise too_large
+            return message
+        
+        await self.app(scope, receive_limited, send)
+
+
+app.add_middleware(UploadSizeLimitMiddleware)
 
 # CORS для фронтенда
 app.add_middleware(
@@ -20,6 +92,29 @@ app.add_middleware(
 FILES_DIR = "/app/files"
 os.makedirs(FILES_DIR, exist_ok=True)
 
+# Ограничения загрузки: число файлов, размер одного файла и суммарный размер
+MAX_FILES = 50
+MAX_FILE_BYTES = 10 << 20
+MAX_TOTAL_BYTES = 100 << 20
+
+# Максимальный размер тела запроса /upload: файлы и запас на заголовки multipart
+MAX_UPLOAD_BODY = MAX_TOTAL_BYTES + (1 << 20)
+
+# Размер буфера при копировании загружаемых файлов (1 МиБ)
+UPLOAD_CHUNK_SIZE = 1 << 20
+
+# Сколько первых байт файла проверять на нулевые байты при определении бинарных файлов
+BINARY_SNIFF_SIZE = 4096
+
+# Кэш содержимого файлов для /files: {filename: (st_mtime_ns, st_size, content)}
+_file_cache: Dict[str, Tuple[int, int, str]] = {}
+
+# Размер пула потоков для файловых операций и постобработки ответов агентов
+THREAD_POOL_SIZE = 8
+
+# Максимальное число команд WebSocket, ожидающих обработки
+WS_QUEUE_SIZE = 8
+
 
 @app.get("/")
 async def root():
@@ -36,24 +131,94 @@ async def root():
     }
 
 
+def _save_upload(file: UploadFile) -> Tuple[str, dict]:
+    """
+    Сохранение загруженного файла во временный файл в FILES_DIR (выполняется
+    в отдельном потоке) блоками по UPLOAD_CHUNK_SIZE. Существующий файл
+    с тем же именем не затрагивается до успешной загрузки всего запроса.
+    
+    Returns:
+        Путь к временному файлу и описание загруженного файла
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=FILES_DIR, prefix=f".{file.filename}.", suffix=".upload")
+    
+    # Размер считаем по записанным байтам, без отдельного stat после записи;
+    # если файл оказался больше лимита, прерываем запись и удаляем его
+    size = 0
+    try:
+        with os.fdopen(fd, "wb") as buffer:
+            # mkstemp создаёт файл с правами 0600: после замены файл получит
+            # права прежней версии или права по умолчанию
+            os.fchmod(buffer.fileno(), file_mode(os.path.join(FILES_DIR, file.filename)))
+            while chunk := file.file.read(UPLOAD_CHUNK_SIZE):
+                size += len(chunk)
+                if size > MAX_FILE_BYTES:
+                    raise HTTPException(
+                        status_code=413,
+                        detail=f"File {file.filename} exceeds {MAX_FILE_BYTES} bytes"
+                    )
+                buffer.write(chunk)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    
+    return tmp_path, {
+        "filename": file.filename,
+        "size": size
+    }
+
+
 @app.post("/upload")
 async def upload_files(files: List[UploadFile] = File(...)):
     """
-    Загрузка до 50 файлов.
+    Загрузка до MAX_FILES файлов.
     Каждый файл сохраняется в /app/files/
+    
+    Общий размер запроса проверяется ещё до разбора формы
+    (UploadSizeLimitMiddleware), размеры файлов - по multipart-запросу и во
+    время записи. Имена файлов - только имена, без путей (иначе 400).
+    Файлы сохраняются все или ни одного: при ошибке в любом из них прежние
+    версии файлов остаются на диске.
     """
-    if len(files) > 50:
-        return {"error": "Maximum 50 files allowed"}
+    if len(files) > MAX_FILES:
+        raise HTTPException(status_code=413, detail=f"Maximum {MAX_FILES} files allowed")
     
-    uploaded = []
     for file in files:
-        file_path = os.path.join(FILES_DIR, file.filename)
-        with open(file_path, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
-        uploaded.append({
-            "filename": file.filename,
-            "size": os.path.getsize(file_path)
-        })
+        try:
+            check_filename(file.filename)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+    
+    sizes = [file.size or 0 for file in files]
+    if any(size > MAX_FILE_BYTES for size in sizes):
+        raise HTTPException(
+            status_code=413,
+            detail=f"Each file must be at most {MAX_FILE_BYTES} bytes"
+        )
+    if sum(sizes) > MAX_TOTAL_BYTES:
+        raise HTTPException(
+            status_code=413,
+            detail=f"Total upload size must be at most {MAX_TOTAL_BYTES} bytes"
+        )
+    
+    # Файлы независимы: сохраняем их параллельно в пуле потоков,
+    # чтобы не блокировать event loop
+    saved = await asyncio.gather(
+        *[asyncio.to_thread(_save_upload, file) for file in files],
+        return_exceptions=True
+    )
+    
+    errors = [result for result in saved if isinstance(result, BaseException)]
+    if errors:
+        for result in saved:
+            if not isinstance(result, BaseException):
+                os.remove(result[0])
+        raise errors[0]
+    
+    uploaded = []
+    for file, (tmp_path, info) in zip(files, saved):
+        os.replace(tmp_path, os.path.join(FILES_DIR, file.filename))
+        uploaded.append(info)
     
     return {
         "status": "success",
@@ -62,28 +227,67 @@ async def upload_files(files: List[UploadFile] = File(...)):
     }
 
 
-@app.get("/files")
-async def list_files():
+def _read_text_file(file_path: str) -> str:
     """
-    Список всех загруженных файлов
+    Чтение содержимого текстового файла; для бинарных файлов - заглушка.
+    Файл считается бинарным, если в его начале есть нулевой байт.
+    """
+    with open(file_path, "rb") as f:
+        head = f.read(BINARY_SNIFF_SIZE)
+        if b"\x00" in head:
+            return "[Binary file]"
+        data = head + f.read()
+    
+    try:
+        return data.decode("utf-8")
+    except UnicodeDecodeError:
+        return "[Binary file]"
+
+
+def _scan_files() -> List[dict]:
+    """
+    Чтение списка файлов и их содержимого из FILES_DIR (выполняется в
+    отдельном потоке). Скрытые файлы - это временные файлы незавершённых
+    записей и загрузок, они пропускаются.
     """
     files = []
-    if os.path.exists(FILES_DIR):
-        for filename in os.listdir(FILES_DIR):
-            file_path = os.path.join(FILES_DIR, filename)
-            if os.path.isfile(file_path):
-                # Читаем содержимое файла (только текстовые)
-                try:
-                    with open(file_path, "r", encoding="utf-8") as f:
-                        content = f.read()
-                except:
-                    content = "[Binary file]"
+    try:
+        # scandir отдаёт тип и stat каждого файла за один проход по каталогу
+        with os.scandir(FILES_DIR) as entries:
+            for entry in entries:
+                if entry.name.startswith(".") or not entry.is_file():
+                    continue
+                
+                # Файл перечитывается, только если изменились mtime или размер
+                stat = entry.stat()
+                cached = _file_cache.get(entry.name)
+                if cached and cached[:2] == (stat.st_mtime_ns, stat.st_size):
+                    content = cached[2]
+                else:
+                    content = _read_text_file(entry.path)
+                    _file_cache[entry.name] = (stat.st_mtime_ns, stat.st_size, content)
                 
                 files.append({
-                    "filename": filename,
-                    "size": os.path.getsize(file_path),
+                    "filename": entry.name,
+                    "size": stat.st_size,
                     "content": content
                 })
+    except FileNotFoundError:
+        pass
+    
+    # Удаляем из кэша файлы, которых больше нет на диске
+    for filename in _file_cache.keys() - {f["filename"] for f in files}:
+        _file_cache.pop(filename, None)
+    
+    return files
+
+
+@app.get("/files")
+async def list_files():
+    """
+    Список всех загруженных файлов
+    """
+    files = await asyncio.to_thread(_scan_files)
     
     return {
         "count": len(files),
@@ -91,6 +295,133 @@ async def list_files():
     }
 
 
+async def _send_json(websocket: WebSocket, send_lock: asyncio.Lock, data: dict):
+    """
+    Отправка JSON-сообщения (сериализация через orjson)
+    """
+    async with send_lock:
+        await websocket.send_text(orjson.dumps(data).decode())
+
+
+async def _send_file_frame(
+    websocket: WebSocket, send_lock: asyncio.Lock, header: dict, content: str
+):
+    """
+    Отправка содержимого файла: JSON-заголовок с длиной "len" в байтах,
+    сразу за ним - бинарное сообщение с содержимым в UTF-8
+    """
+    payload = content.encode("utf-8")
+    async with send_lock:
+        await websocket.send_text(orjson.dumps({**header, "len": len(payload)}).decode())
+        await websocket.send_bytes(payload)
+
+
+async def _resolve_files(data: dict) -> Dict[str, str]:
+    """
+    Файлы для команды: по именам из FILES_DIR ("filenames") или переданные
+    целиком в запросе ("files", устаревший формат)
+    """
+    filenames = data.get("filenames")
+    if filenames is not None:
+        return await asyncio.to_thread(load_files, filenames)
+    return data.get("files", {})
+
+
+async def _ws_reader(websocket: WebSocket, send_lock: asyncio.Lock, queue: asyncio.Queue):
+    """
+    Читает команды из WebSocket и ставит их в очередь на обработку.
+    Когда очередь заполнена, чтение приостанавливается (backpressure).
+    """
+    while True:
+        # Получаем сообщение от клиента
+        data = orjson.loads(await websocket.receive_text())
+        
+        command = data.get("command", "")
+        
+        if not command:
+            await _send_json(websocket, send_lock, {
+                "type": "error",
+                "message": "No command provided"
+            })
+            continue
+        
+        await queue.put((command, data))
+
+
+async def _ws_worker(
+    websocket: WebSocket, send_lock: asyncio.Lock, queue: asyncio.Queue, agent_system
+):
+    """
+    Обрабатывает команды из очереди и отправляет результаты в WebSocket
+    """
+    while True:
+        command, data = await queue.get()
+        
+        # Идентификатор команды: по нему клиент сопоставляет сообщения
+        # о файлах, которые обрабатываются параллельно
+        request_id = uuid.uuid4().hex
+        
+        async def send_file_delta(filename: str, delta: str):
+            await _send_file_frame(websocket, send_lock, {
+                "type": "file_delta",
+                "request_id": request_id,
+                "file": filename
+            }, delta)
+        
+        async def send_file_update(filename: str, content, message: str):
+            header = {
+                "type": "file_update",
+                "request_id": request_id,
+                "file": filename,
+                "message": message
+            }
+            if content is None:
+                await _send_json(websocket, send_lock, header)
+            else:
+                await _send_file_frame(websocket, send_lock, header, content)
+        
+        # Обработка команды через multi-agent систему
+        try:
+            files = await _resolve_files(data)
+            
+            # Отправляем статус начала обработки
+            await _send_json(websocket, send_lock, {
+                "type": "processing",
+                "request_id": request_id,
+                "message": f"Processing command: {command}",
+                "files_count": len(files)
+            })
+            
+            result = await agent_system.process_command(
+                command,
+                files,
+                tier="priority",
+                on_file=send_file_update,
+                on_chunk=send_file_delta
+            )
+            
+            # Отправляем результат; содержимое файлов уже передано в "file_update"
+            await _send_json(websocket, send_lock, {
+                "type": "result",
+                "request_id": request_id,
+                "status": result["status"],
+                "result": result["result"],
+                "updated_files": list(result["updated_files"]),
+                "messages": result["messages"]
+            })
+            
+        except WebSocketDisconnect:
+            raise
+        except Exception as e:
+            await _send_json(websocket, send_lock, {
+                "type": "error",
+                "request_id": request_id,
+                "message": f"Error processing command: {str(e)}"
+            })
+        finally:
+            queue.task_done()
+
+
 @app.websocket("/ws")
 async def websocket_endpoint(websocket: WebSocket):
     """
@@ -99,16 +430,30 @@ async def websocket_endpoint(websocket: WebSocket):
     Пример сообщения:
     {
         "command": "Add TODO comment to file1.txt",
-        "files": {
-            "file1.txt": "content here",
-            "file2.py": "print('hello')"
-        }
+        "filenames": ["file1.txt", "file2.py"]
     }
+    
+    Файлы читаются с сервера из /app/files/. Устаревший формат с полным
+    содержимым файлов в поле "files" ({filename: content}) пока поддерживается.
+    
+    Команды ставятся в очередь (до WS_QUEUE_SIZE штук) и обрабатываются
+    по порядку. Во время обработки приходят сообщения "file_delta" с
+    фрагментами ответа агента, по готовности каждого файла - "file_update",
+    по завершении команды - "result" со списком имён файлов. Все они
+    содержат request_id команды.
+    
+    Содержимое файлов не кодируется в JSON: если в "file_delta" или
+    "file_update" есть поле "len", следом идёт бинарное сообщение длиной
+    len байт с содержимым в UTF-8.
     """
     await websocket.accept()
     
+    # Отправка сообщений из reader и worker: заголовок и бинарное
+    # сообщение с содержимым файла не должны разделяться другими сообщениями
+    send_lock = asyncio.Lock()
+    
     # Приветственное сообщение
-    await websocket.send_json({
+    await _send_json(websocket, send_lock, {
         "type": "connection",
         "message": "Connected to Multi-Agent File Editor",
         "status": "ready"
@@ -119,7 +464,7 @@ async def websocket_endpoint(websocket: WebSocket):
         try:
             agent_system = get_agent_system()
         except ValueError as e:
-            await websocket.send_json({
+            await _send_json(websocket, send_lock, {
                 "type": "error",
                 "message": str(e),
                 "hint": "Set GOOGLE_API_KEY environment variable"
@@ -127,52 +472,30 @@ async def websocket_endpoint(websocket: WebSocket):
             await websocket.close()
             return
         
-        while True:
-            # Получаем сообщение от клиента
-            data = await websocket.receive_json()
-            
-            command = data.get("command", "")
-            files = data.get("files", {})
-            
-            if not command:
-                await websocket.send_json({
-                    "type": "error",
-                    "message": "No command provided"
-                })
-                continue
-            
-            # Отправляем статус начала обработки
-            await websocket.send_json({
-                "type": "processing",
-                "message": f"Processing command: {command}",
-                "files_count": len(files)
-            })
-            
-            # Обработка команды через multi-agent систему
-            try:
-                result = agent_system.process_command(command, files)
-                
-                # Отправляем результат
-                await websocket.send_json({
-                    "type": "result",
-                    "status": result["status"],
-                    "result": result["result"],
-                    "updated_files": result["updated_files"],
-                    "messages": result["messages"]
-                })
-                
-            except Exception as e:
-                await websocket.send_json({
-                    "type": "error",
-                    "message": f"Error processing command: {str(e)}"
-                })
+        queue = asyncio.Queue(maxsize=WS_QUEUE_SIZE)
+        reader = asyncio.create_task(_ws_reader(websocket, send_lock, queue))
+        worker = asyncio.create_task(_ws_worker(websocket, send_lock, queue, agent_system))
+        
+        # Чтение и обработка идут независимо; как только одна из задач
+        # завершилась (обычно из-за отключения клиента), останавливаем другую
+        try:
+            done, _ = await asyncio.wait(
+                {reader, worker}, return_when=asyncio.FIRST_COMPLETED
+            )
+        finally:
+            reader.cancel()
+            worker.cancel()
+            await asyncio.gather(reader, worker, return_exceptions=True)
+        
+        for task in done:
+            task.result()
     
     except WebSocketDisconnect:
         print("Client disconnected")
     except Exception as e:
         print(f"WebSocket error: {e}")
         try:
-            await websocket.send_json({
+            await _send_json(websocket, send_lock, {
                 "type": "error",
                 "message": f"Unexpected error: {str(e)}"
             })
@@ -181,19 +504,38 @@ async def websocket_endpoint(websocket: WebSocket):
 
 
 @app.post("/process")
-async def process_command(data: dict):
+async def process_command(data: dict, mode: str = "sync"):
     """
     HTTP endpoint для обработки команд (альтернатива WebSocket)
+    
+    Формат запроса такой же, как у WebSocket: {"command": ..., "filenames": [...]}
+    (или устаревший {"command": ..., "files": {filename: content}})
+    
+    mode=batch - запросы к файлам отправляются одним Gemini Batch заданием:
+    вдвое дешевле, но результат может готовиться до суток. Ответ приходит
+    сразу со status "pending" и именем задания в "job"; результат забирается
+    через GET /batch/{job}.
     """
+    if mode not in ("sync", "batch"):
+        raise HTTPException(status_code=400, detail=f"Unknown mode: {mode}")
+    
     command = data.get("command", "")
-    files = data.get("files", {})
     
     if not command:
         return {"error": "No command provided"}
     
+    try:
+        files = await _resolve_files(data)
+    except (OSError, ValueError) as e:
+        # ValueError - недопустимые имена файлов или не UTF-8 содержимое
+        return {"error": f"Error reading files: {str(e)}"}
+    
     try:
         agent_system = get_agent_system()
-        result = agent_system.process_command(command, files)
+        if mode == "batch":
+            result = await agent_system.process_command_batch(command, files)
+        else:
+            result = await agent_system.process_command(command, files, tier="flex")
         return result
     except ValueError as e:
         return {
@@ -204,3 +546,26 @@ async def process_command(data: dict):
         return {
             "error": f"Error processing command: {str(e)}"
         }
+
+
+@app.get("/batch/{job_name:path}")
+async def get_batch_result(job_name: str):
+    """
+    Результат batch-задания, отправленного через /process?mode=batch:
+    status "pending", пока задание выполняется, затем - результат обработки
+    в том же формате, что и у /process. Результат выдаётся один раз.
+    """
+    try:
+        agent_system = get_agent_system()
+        return await agent_system.collect_batch(job_name)
+    except KeyError:
+        raise HTTPException(status_code=404, detail=f"Unknown batch job: {job_name}")
+    except ValueError as e:
+        return {
+            "error": str(e),
+            "hint": "Set GOOGLE_API_KEY environment variable"
+        }
+    except Exception as e:
+        return {
+            "error": f"Error collecting batch results: {str(e)}"
+        }
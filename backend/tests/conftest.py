@@ -0,0 +1,16 @@
+"""
+Общие фикстуры тестов
+"""
+
+import pytest
+
+from app import agents
+
+
+@pytest.fixture
+def agent_system(tmp_path, monkeypatch):
+    """
+    Multi-agent система с FILES_DIR во временном каталоге (без обращений к API)
+    """
+    monkeypatch.setattr(agents, "FILES_DIR", str(tmp_path))
+    return agents.MultiAgentSystem(api_key="test")
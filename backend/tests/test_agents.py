@@ -0,0 +1,186 @@
+"""
+Тесты multi-agent системы (без обращений к Gemini API)
+"""
+
+import json
+
+import pytest
+
+from app import agents
+from app.agents import (
+    FAST_RULES,
+    MultiAgentSystem,
+    _add_todo_comment,
+    _remove_blank_lines,
+    _rename_identifier,
+)
+
+
+def _match(command: str):
+    """
+    Первое быстрое правило, под которое подходит команда: (match, transform)
+    """
+    for pattern, transform in FAST_RULES:
+        match = pattern.fullmatch(command)
+        if match:
+            return match, transform
+    return None, None
+
+
+def test_add_todo_comment_uses_comment_syntax():
+    match, transform = _match("add todo comment")
+    assert transform is _add_todo_comment
+    assert _add_todo_comment(match, "a.py", "x = 1\n") == "x = 1\n# TODO\n"
+    assert _add_todo_comment(match, "a.js", "let x") == "let x\n// TODO\n"
+    assert _add_todo_comment(match, "notes.txt", "") == "TODO\n"
+
+
+def test_add_todo_comment_unknown_extension():
+    match, _ = _match("add todo comment")
+    assert _add_todo_comment(match, "image.png", "data") is None
+
+
+def test_rename_identifier_whole_words():
+    match, transform = _match("rename `foo` to bar")
+    assert transform is _rename_identifier
+    content = "foo = 1\nfood = foo + 1\n"
+    assert _rename_identifier(match, "a.py", content) == "bar = 1\nfood = bar + 1\n"
+
+
+def test_rename_identifier_russian():
+    match, transform = _match("Переименуй foo в bar в a.py")
+    assert transform is _rename_identifier
+    assert match.group("old", "new", "target") == ("foo", "bar", "a.py")
+
+
+def test_remove_blank_lines():
+    match, transform = _match("remove all empty lines from a.py.")
+    assert transform is _remove_blank_lines
+    assert _remove_blank_lines(match, "a.py", "a\n\n  \nb\n\t\n") == "a\nb\n"
+
+
+def test_fast_rule_target():
+    match, _ = _match("Add TODO comment to 'a.py'")
+    assert match.group("target") == "a.py"
+    match, _ = _match("Добавь TODO-комментарий в a.py")
+    assert match.group("target") == "a.py"
+    # Цель, не похожая на имя файла, остаётся LLM
+    assert _match("Add TODO comment to main()") == (None, None)
+
+
+def test_parse_plan():
+    text = json.dumps([
+        {"file": "a.py", "instruction": "add docstrings"},
+        {"file": "b.py", "instruction": "rename x to y"},
+    ])
+    assert MultiAgentSystem._parse_plan(text) == [
+        {"file": "a.py", "instruction": "add docstrings"},
+        {"file": "b.py", "instruction": "rename x to y"},
+    ]
+
+
+def test_parse_plan_merges_steps_for_same_file():
+    text = json.dumps([
+        {"file": "a.py", "instruction": "add docstrings"},
+        {"file": "b.py", "instruction": "rename x to y"},
+        {"file": "a.py", "instruction": "add type hints"},
+    ])
+    assert MultiAgentSystem._parse_plan(text) == [
+        {"file": "a.py", "instruction": "add docstrings\nadd type hints"},
+        {"file": "b.py", "instruction": "rename x to y"},
+    ]
+
+
+def test_parse_plan_invalid():
+    assert MultiAgentSystem._parse_plan("not json") == []
+    assert MultiAgentSystem._parse_plan('{"file": "a.py"}') == []
+    assert MultiAgentSystem._parse_plan('[{"file": "a.py"}, "b.py"]') == []
+
+
+def test_strip_fences():
+    assert MultiAgentSystem._strip_fences("```python\nx = 1\n```\n") == "x = 1"
+    assert MultiAgentSystem._strip_fences("  x = 1\n") == "x = 1"
+    # Блоки кода внутри текста не считаются обёрткой
+    text = "# Title\n```\ncode\n```\nmore"
+    assert MultiAgentSystem._strip_fences(text) == text
+
+
+def test_cache_key_includes_filename(agent_system):
+    key = agent_system._cache_key("a/__init__.py", "add a module docstring", "")
+    assert key == agent_system._cache_key("a/__init__.py", "add a module docstring", "")
+    assert key != agent_system._cache_key("b/__init__.py", "add a module docstring", "")
+    assert key != agent_system._cache_key("a/__init__.py", "add a module docstring", "\n")
+
+
+def test_cache_lru_eviction(agent_system, monkeypatch):
+    monkeypatch.setattr(agents, "CACHE_MAX_SIZE", 2)
+    agent_system._cache_put("k1", "v1")
+    agent_system._cache_put("k2", "v2")
+    assert agent_system._cache_get("k1") == "v1"
+    agent_system._cache_put("k3", "v3")
+    assert agent_system._cache_get("k2") is None
+    assert agent_system._cache_get("k1") == "v1"
+    assert agent_system._cache_get("k3") == "v3"
+
+
+def test_save_file_skips_unchanged_content(agent_system, tmp_path):
+    agent_system._save_file("a.py", "x = 1\n")
+    path = tmp_path / "a.py"
+    assert path.read_text() == "x = 1\n"
+    inode = path.stat().st_ino
+    
+    # То же содержимое - файл не перезаписывается
+    agent_system._save_file("a.py", "x = 1\n")
+    assert path.stat().st_ino == inode
+    
+    agent_system._save_file("a.py", "x = 2\n")
+    assert path.read_text() == "x = 2\n"
+    assert path.stat().st_ino != inode
+
+
+def test_save_file_keeps_mode_and_cleans_up(agent_system, tmp_path):
+    path = tmp_path / "run.sh"
+    path.write_text("echo 1\n")
+    path.chmod(0o755)
+    
+    agent_system._save_file("run.sh", "echo 2\n")
+    assert path.read_text() == "echo 2\n"
+    assert path.stat().st_mode & 0o7777 == 0o755
+    assert [p.name for p in tmp_path.iterdir()] == ["run.sh"]
+    
+    agent_system._save_file("new.txt", "new\n")
+    assert (tmp_path / "new.txt").stat().st_mode & 0o7777 == agents.DEFAULT_FILE_MODE
+
+
+def test_save_file_removes_temp_file_on_error(agent_system, tmp_path, monkeypatch):
+    def fail(src, dst):
+        raise OSError("disk full")
+    
+    monkeypatch.setattr(agents.os, "replace", fail)
+    agent_system._save_file("a.py", "x = 1\n")
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_load_files(tmp_path, monkeypatch):
+    monkeypatch.setattr(agents, "FILES_DIR", str(tmp_path))
+    (tmp_path / "a.txt").write_text("привет")
+    (tmp_path / "empty.txt").write_text("")
+    assert agents.load_files(["a.txt", "empty.txt"]) == {"a.txt": "привет", "empty.txt": ""}
+
+
+@pytest.mark.parametrize("filenames", [
+    "a.txt",
+    ["sub/a.txt"],
+    ["../a.txt"],
+    [".."],
+    ["..\\a.txt"],
+    ["/etc/passwd"],
+    [1],
+])
+def test_load_files_rejects_invalid_names(tmp_path, monkeypatch, filenames):
+    monkeypatch.setattr(agents, "FILES_DIR", str(tmp_path / "files"))
+    (tmp_path / "files").mkdir()
+    (tmp_path / "files" / "a.txt").write_text("a")
+    (tmp_path / "a.txt").write_text("outside")
+    with pytest.raises(ValueError):
+        agents.load_files(filenames)
@@ -0,0 +1,100 @@
+"""
+Тесты HTTP API: загрузка файлов
+"""
+
+import asyncio
+import io
+
+import pytest
+from fastapi import HTTPException, UploadFile
+from fastapi.testclient import TestClient
+
+from app import agents, main
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    """
+    Клиент API с FILES_DIR во временном каталоге
+    """
+    monkeypatch.setattr(main, "FILES_DIR", str(tmp_path))
+    monkeypatch.setattr(agents, "FILES_DIR", str(tmp_path))
+    return TestClient(main.app)
+
+
+def test_upload_saves_files(client, tmp_path):
+    response = client.post("/upload", files=[
+        ("files", ("a.txt", b"hello")),
+        ("files", ("b.py", b"x = 1\n")),
+    ])
+    assert response.status_code == 200
+    assert response.json()["uploaded_count"] == 2
+    assert (tmp_path / "a.txt").read_bytes() == b"hello"
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["a.txt", "b.py"]
+    assert (tmp_path / "a.txt").stat().st_mode & 0o7777 == agents.DEFAULT_FILE_MODE
+
+
+def test_upload_keeps_existing_file_mode(client, tmp_path):
+    path = tmp_path / "run.sh"
+    path.write_bytes(b"echo 1\n")
+    path.chmod(0o755)
+    
+    assert client.post("/upload", files=[("files", ("run.sh", b"echo 2\n"))]).status_code == 200
+    assert path.read_bytes() == b"echo 2\n"
+    assert path.stat().st_mode & 0o7777 == 0o755
+
+
+def test_upload_file_too_large_writes_nothing(client, tmp_path, monkeypatch):
+    monkeypatch.setattr(main, "MAX_FILE_BYTES", 10)
+    (tmp_path / "a.py").write_bytes(b"orig")
+    
+    response = client.post("/upload", files=[
+        ("files", ("ok.txt", b"ok")),
+        ("files", ("a.py", b"x" * 50)),
+    ])
+    assert response.status_code == 413
+    assert (tmp_path / "a.py").read_bytes() == b"orig"
+    assert [p.name for p in tmp_path.iterdir()] == ["a.py"]
+
+
+def test_upload_overflow_during_write_writes_nothing(tmp_path, monkeypatch):
+    # Размер файла неизвестен заранее - лимит срабатывает во время записи
+    monkeypatch.setattr(main, "FILES_DIR", str(tmp_path))
+    monkeypatch.setattr(main, "MAX_FILE_BYTES", 10)
+    (tmp_path / "a.py").write_bytes(b"orig")
+    files = [
+        UploadFile(io.BytesIO(b"ok"), filename="ok.txt"),
+        UploadFile(io.BytesIO(b"x" * 50), filename="a.py"),
+    ]
+    
+    with pytest.raises(HTTPException) as exc_info:
+        asyncio.run(main.upload_files(files))
+    assert exc_info.value.status_code == 413
+    assert (tmp_path / "a.py").read_bytes() == b"orig"
+    assert [p.name for p in tmp_path.iterdir()] == ["a.py"]
+
+
+def test_upload_body_too_large(client, tmp_path, monkeypatch):
+    monkeypatch.setattr(main, "MAX_UPLOAD_BODY", 100)
+    
+    response = client.post("/upload", files=[("files", ("a.txt", b"y" * 200))])
+    assert response.status_code == 413
+    
+    # Без Content-Length (chunked) размер считается по полученным байтам
+    response = client.post(
+        "/upload",
+        content=iter([b"y" * 60, b"y" * 60]),
+        headers={"content-type": "multipart/form-data; boundary=x"}
+    )
+    assert response.status_code == 413
+    assert list(tmp_path.iterdir()) == []
+
+
+@pytest.mark.parametrize("filename", ["../evil.txt", "/abs", "sub/a.txt", ".hidden"])
+def test_upload_rejects_invalid_names(client, tmp_path, filename):
+    response = client.post("/upload", files=[
+        ("files", ("ok.txt", b"ok")),
+        ("files", (filename, b"x")),
+    ])
+    assert response.status_code == 400
+    assert list(tmp_path.iterdir()) == []